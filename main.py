@@ -10,8 +10,10 @@ from urllib.parse import urlparse
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 import uuid
-import threading
+import time
+import math
 import mimetypes
+from collections import OrderedDict
 
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -31,10 +33,127 @@ logger = logging.getLogger(__name__)
 
 
 
+class TokenBucketLimiter:
+    """
+    In-process token buckets keyed by string. Buckets live in an OrderedDict
+    used as an LRU, so refill, take and eviction are all O(1) and memory is
+    capped at max_keys. An evicted bucket simply starts again full.
+    """
+
+    def __init__(self, max_keys: int = 10000):
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+
+    async def acquire(self, key: str, rate: float, capacity: float, cost: float = 1) -> float:
+        """
+        Take cost tokens from key's bucket. Returns 0 if admitted, otherwise
+        the number of seconds until enough tokens will be available.
+        """
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens >= cost:
+            tokens -= cost
+            retry_after = 0.0
+        else:
+            retry_after = (cost - tokens) / rate
+        self.buckets[key] = (min(capacity, tokens), now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return retry_after
+
+    async def refund(self, key: str, rate: float, capacity: float, cost: float = 1):
+        await self.acquire(key, rate, capacity, -cost)
+
+
+class RedisTokenBucketLimiter:
+    """
+    Token buckets shared between workers through Redis. The refill-and-take
+    step runs as a Lua script so it is atomic across processes. If Redis is
+    unreachable, falls back to a local TokenBucketLimiter instead of
+    blocking users, and stays on it for BREAKER_COOLDOWN seconds so not
+    every request pays the timeout.
+    """
+
+    SOCKET_TIMEOUT = 0.5
+    BREAKER_COOLDOWN = 30
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local now = tonumber(ARGV[4])
+    local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local retry_after = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+    else
+        retry_after = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', math.min(capacity, tokens), 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, redis_url: str):
+        import redis.asyncio as redis  # optional dependency, only needed for shared limits
+        self.redis = redis.from_url(
+            redis_url,
+            socket_connect_timeout=self.SOCKET_TIMEOUT,
+            socket_timeout=self.SOCKET_TIMEOUT
+        )
+        self.script = self.redis.register_script(self.SCRIPT)
+        self.fallback = TokenBucketLimiter()
+        self.breaker_open_until = 0.0
+
+    async def acquire(self, key: str, rate: float, capacity: float, cost: float = 1) -> float:
+        if time.monotonic() < self.breaker_open_until:
+            return await self.fallback.acquire(key, rate, capacity, cost)
+        try:
+            retry_after = await self.script(
+                keys=[f"ratelimit:{key}"],
+                args=[rate, capacity, cost, time.time()]
+            )
+            return float(retry_after)
+        except Exception as e:
+            logger.error(f"Shared rate limiter unavailable, using local buckets: {e}")
+            self.breaker_open_until = time.monotonic() + self.BREAKER_COOLDOWN
+            return await self.fallback.acquire(key, rate, capacity, cost)
+
+    async def refund(self, key: str, rate: float, capacity: float, cost: float = 1):
+        await self.acquire(key, rate, capacity, -cost)
+
+
 class TelegramDownloaderBot:
     SUPPORTED_VIDEO_EXTENSIONS = {'.mp4', '.webm', '.avi', '.mov', '.mkv', '.flv', '.wmv', '.m4v', '.3gp', '.ogv'}
-    storage_lock = threading.Lock()
+    storage_lock = asyncio.Lock()
     MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
+    PARTIAL_DIR = os.path.join(tempfile.gettempdir(), "angry_downloader_partials")
+    PARTIAL_FILE_TTL = 6 * 60 * 60  # 6 hours
+    PARTIAL_GC_INTERVAL = 30 * 60  # 30 minutes
+    MAX_RESUME_ATTEMPTS = 5
+    METADATA_CACHE_TTL = 10 * 60  # 10 minutes
+    METADATA_CACHE_SIZE = 1024
+    LINK_TTL = 8 * 60  # assumed lifetime of a signed TeraBox link
+    PREFETCH_MARGIN = 60  # refresh this many seconds before LINK_TTL runs out
+    PREFETCH_MAX_REFRESHES = 1  # link regenerations per button before giving up
+    PREFETCH_MAX_TASKS = 50  # buttons being kept warm at once
+    PREFETCH_CONCURRENCY = 3  # upstream requests in flight for prefetching
+    # Admission control: (tokens per second, burst capacity)
+    USER_RATE_LIMITS = {
+        "link": (1 / 10, 5),  # one link every 10s, bursts of 5
+        "video": (1 / 60, 2),  # one Get Video every minute, bursts of 2
+    }
+    MAX_FILES_PER_LINK = 5  # generate_link calls per shared link; matches the "link" burst
+    BACKEND_RATE_LIMITS = {
+        "terabox": (5, 20),
+        "vkr": (5, 20),
+        # Global budget for speculative prefetch rounds (mirror probe or link refresh)
+        "prefetch": (0.2, 5),
+    }
 
 
     async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -89,30 +208,43 @@ class TelegramDownloaderBot:
 
 
 
-    
-
-    def get_user_links(self, user_id):
-        """
-        Return list of links for user_id (as str), or [].
-        """
+    def read_user_links_data(self):
         filename = "abc.txt"
         try:
             if os.path.exists(filename):
                 with open(filename, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-            else:
-                data = {}
+                    return json.load(f)
         except Exception:
-            data = {}
+            pass
+        return {}
+
+    async def get_user_links(self, user_id):
+        """
+        Return list of links for user_id (as str), or [].
+        File I/O runs in a worker thread so it never blocks the event loop.
+        """
+        async with self.storage_lock:
+            data = await asyncio.to_thread(self.read_user_links_data)
         return data.get(str(user_id), {}).get("links", [])
 
+    def write_json_atomic(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
 
 
 
 
 
-    def __init__(self, bot_token: str):
+
+    def __init__(self, bot_token: str, speculative_prefetch: bool = False,
+                 rate_limit_redis_url: Optional[str] = None):
         self.bot_token = bot_token
+        self.speculative_prefetch = speculative_prefetch
+        self.rate_limiter = self.build_rate_limiter(rate_limit_redis_url)
         self.video_callback_params = {}
         self.terabox_api_url = "https://teradl-api.dapuntaratya.com/generate_file"
         self.terabox_link_api_url = "https://teradl-api.dapuntaratya.com/generate_link"
@@ -125,6 +257,15 @@ class TelegramDownloaderBot:
         ]
         # We'll keep a session dict in memory to map fs_id -> download_urls for quick access
         self.fs_id_to_download_urls = {}
+        # Job keys of downloads in progress, so GC and double clicks leave them alone
+        self.active_downloads = set()
+        self.partial_gc_task = None
+        # url -> (probed_at, {"size", "content_type", "accept_ranges"}), oldest first
+        self.url_metadata = {}
+        # Speculative prefetch state, keyed by the Get Video callback id
+        self.prefetch_tasks = {}
+        self.prefetched_links = {}  # unique_id -> (fetched_at, winning_url)
+        self.prefetch_semaphore = asyncio.Semaphore(self.PREFETCH_CONCURRENCY)
         # For generic/video links from VKR, can use message_id or similar to keep state if needed
 
 
@@ -248,67 +389,40 @@ Just send me any supported link and I'll provide download links for you!
 
 
     
-    async def download_and_send_video(self, message, context, video_url):
+    async def download_and_send_video(self, message, context, video_url, refresh_urls=None, job_key=None,
+                                      known_size=0):
+        """
+        Download video_url into a checkpointed partial file and send it.
+        If the transfer drops, resume with a Range request; if the signed URL
+        has expired, ask refresh_urls() for a fresh link and resume from there.
+        """
+        # Scope the job to the chat so users sharing a popular file don't block each other
+        job_key = f"{message.chat_id}_{job_key or uuid.uuid5(uuid.NAMESPACE_URL, video_url).hex}"
+        if job_key in self.active_downloads:
+            await message.reply_text("⏳ This file is already being downloaded. Please wait!")
+            return
+        self.active_downloads.add(job_key)
+        progress_msg = None
+        tmp_file_path = None
         try:
-            file_ext = self.get_extension_from_url(video_url)
-            file_name = "video"
-    
             # 1. Send a progress message
             progress_msg = await message.reply_text("⬇️ Downloading... 0%")
-    
-            async with aiohttp.ClientSession() as session:
-                async with session.get(video_url) as resp:
-                    if resp.status == 200:
-                        total_size = int(resp.headers.get("Content-Length", 0))
-                        if total_size and total_size > self.MAX_FILE_SIZE:
-                            await progress_msg.edit_text(
-                                f"😊 Sorry, this feature is only available for files < 100 MB.\n"
-                                f"Detected file size: {self.format_file_size(total_size)}\n\n"
-                                "Please use the direct download links instead!"
-                            )
-                            return
-    
-                        # Extension guessing as before
-                        if not file_ext:
-                            content_type = resp.headers.get("Content-Type", "")
-                            ext_from_type = mimetypes.guess_extension(content_type.split(";")[0].strip())
-                            file_ext = ext_from_type if ext_from_type else ".mp4"
-    
-                        disp = resp.headers.get("Content-Disposition", "")
-                        if "filename=" in disp:
-                            file_name = disp.split("filename=")[1].split(";")[0].strip('"\' ')
-                        else:
-                            file_name = f"video{file_ext}"
-    
-                        # Download in chunks and update progress
-                        chunk_size = 1024 * 1024  # 1 MB
-                        downloaded = 0
-                        last_percent = 0
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-                            async for chunk in resp.content.iter_chunked(chunk_size):
-                                if not chunk:
-                                    break
-                                tmp_file.write(chunk)
-                                downloaded += len(chunk)
-                                if total_size:
-                                    percent = int(downloaded * 100 / total_size)
-                                    # Update progress message every 10%
-                                    if percent // 10 > last_percent // 10:
-                                        await progress_msg.edit_text(f"⬇️ Downloading... {percent}%")
-                                        last_percent = percent
-                            tmp_file_path = tmp_file.name
-                    else:
-                        await progress_msg.edit_text(
-                            "😊 Failed to download the video.\n\n"
-                            "👉 For large videos or better support, try our Android app!\n"
-                            "[📲 Download Android App](https://play.google.com/store/apps/details?id=com.chandu.angry_downloader)",
-                            parse_mode='Markdown'
-                        )
 
-                        return
-    
+            result = await self.download_with_resume(video_url, job_key, progress_msg, refresh_urls, known_size)
+            if result is None:
+                await progress_msg.edit_text(
+                    "😊 Failed to download the video.\n\n"
+                    "👉 For large videos or better support, try our Android app!\n"
+                    "[📲 Download Android App](https://play.google.com/store/apps/details?id=com.chandu.angry_downloader)",
+                    parse_mode='Markdown'
+                )
+                return
+            if result == "too_large":
+                return
+            tmp_file_path, file_name, file_ext = result
+
             await progress_msg.edit_text("✅ Download complete! Sending...")
-    
+
             # Send as video if extension is a known video, else as document
             if file_ext.lower() in [".mp4", ".mkv", ".webm"]:
                 with open(tmp_file_path, "rb") as video_file:
@@ -316,22 +430,378 @@ Just send me any supported link and I'll provide download links for you!
             else:
                 with open(tmp_file_path, "rb") as video_file:
                     await message.reply_document(video_file, filename=file_name)
-            os.remove(tmp_file_path)
             await progress_msg.delete()
-    
+
         except Exception as e:
             logger.error(f"Error downloading/sending video: {e}")
             try:
                 await progress_msg.edit_text("😊 Error sending video file.")
             except:
                 await message.reply_text("😊 Error sending video file.")
+        finally:
+            self.active_downloads.discard(job_key)
+            if tmp_file_path:
+                await asyncio.to_thread(self.delete_files, tmp_file_path)
+
+
+
+    def partial_paths(self, job_key):
+        safe_key = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(job_key))
+        base = os.path.join(self.PARTIAL_DIR, safe_key)
+        return f"{base}.part", f"{base}.json"
+
+    def delete_files(self, *paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def partial_size(self, part_path):
+        return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    def finalize_partial(self, part_path, file_ext):
+        # Move the finished file out of the partial dir so GC never races the upload
+        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
+            tmp_file_path = tmp_file.name
+        os.replace(part_path, tmp_file_path)
+        return tmp_file_path
+
+    def read_checkpoint(self, checkpoint_path):
+        try:
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    async def load_checkpoint(self, checkpoint_path):
+        return await asyncio.to_thread(self.read_checkpoint, checkpoint_path)
+
+    async def save_checkpoint(self, checkpoint_path, checkpoint):
+        await asyncio.to_thread(self.write_json_atomic, checkpoint_path, dict(checkpoint))
+
+    def parse_content_range_total(self, content_range):
+        # "bytes 100-199/1000" -> 1000
+        try:
+            total = content_range.rsplit("/", 1)[1].strip()
+            return int(total) if total != "*" else 0
+        except (IndexError, ValueError):
+            return 0
+
+    async def download_with_resume(self, video_url, job_key, progress_msg, refresh_urls=None, known_size=0):
+        """
+        Returns (file_path, file_name, file_ext), "too_large", or None on failure.
+        known_size (e.g. TeraBox's size from /generate_file) replaces the HEAD probe.
+        The partial file and its checkpoint are kept on failure so a later
+        attempt for the same job_key resumes instead of starting over.
+        """
+        await asyncio.to_thread(os.makedirs, self.PARTIAL_DIR, exist_ok=True)
+        part_path, checkpoint_path = self.partial_paths(job_key)
+        checkpoint = await self.load_checkpoint(checkpoint_path)
+        if not await asyncio.to_thread(os.path.exists, part_path):
+            checkpoint = {}
+        current_url = video_url
+
+        chunk_size = 1024 * 1024  # 1 MB
+        attempt = 0
+        last_percent = 0
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            # Reject oversized files before committing to the GET
+            metadata = None if known_size else await self.probe_url_metadata(session, current_url)
+            size = known_size or (metadata["size"] if metadata else 0)
+            if size > self.MAX_FILE_SIZE:
+                await self.send_too_large_message(progress_msg, size)
+                await self.remove_partial(job_key)
+                return "too_large"
+
+            while attempt <= self.MAX_RESUME_ATTEMPTS:
+                offset = await asyncio.to_thread(self.partial_size, part_path)
+                total_size = checkpoint.get("total_size", 0)
+                if total_size and offset >= total_size:
+                    break
+                if metadata and not metadata["accept_ranges"]:
+                    offset = 0
+
+                headers = {"Range": f"bytes={offset}-"} if offset else {}
+                try:
+                    async with session.get(current_url, headers=headers) as resp:
+                        if resp.status in (401, 403, 404, 410) and refresh_urls:
+                            # Signed link expired mid-download: regenerate and resume
+                            attempt += 1
+                            fresh_urls = await refresh_urls()
+                            fresh_url = next((url for url in fresh_urls if url), None)
+                            if not fresh_url:
+                                logger.error(f"Could not refresh expired link for {job_key}")
+                                return None
+                            logger.info(f"Refreshed expired link for {job_key}, resuming at {offset}")
+                            current_url = fresh_url
+                            if not known_size:
+                                metadata = await self.probe_url_metadata(session, current_url)
+                            continue
+                        if resp.status == 416 and offset:
+                            # Range past end: complete only if the server agrees on the size
+                            actual_size = self.parse_content_range_total(resp.headers.get("Content-Range", ""))
+                            if actual_size and actual_size == offset:
+                                break
+                            logger.warning(f"Partial file for {job_key} doesn't match the server, restarting")
+                            await self.remove_partial(job_key)
+                            checkpoint = {}
+                            attempt += 1
+                            continue
+                        if resp.status not in (200, 206):
+                            logger.error(f"Download of {job_key} returned status {resp.status}")
+                            return None
+
+                        if resp.status == 206:
+                            total_size = self.parse_content_range_total(resp.headers.get("Content-Range", ""))
+                            expected_size = checkpoint.get("total_size", 0)
+                            if expected_size and total_size != expected_size:
+                                # A regenerated link serving different content: the partial is useless
+                                logger.warning(
+                                    f"Size changed for {job_key} ({expected_size} -> {total_size}), restarting"
+                                )
+                                await self.remove_partial(job_key)
+                                checkpoint = {}
+                                attempt += 1
+                                continue
+                        else:
+                            # Server ignored Range: start over from byte 0
+                            offset = 0
+                            total_size = int(resp.headers.get("Content-Length", 0))
+
+                        if total_size and total_size > self.MAX_FILE_SIZE:
+                            await self.send_too_large_message(progress_msg, total_size)
+                            await self.remove_partial(job_key)
+                            return "too_large"
+
+                        if "file_ext" not in checkpoint:
+                            file_ext = self.get_extension_from_url(video_url)
+                            if not file_ext:
+                                content_type = resp.headers.get("Content-Type", "")
+                                ext_from_type = mimetypes.guess_extension(content_type.split(";")[0].strip())
+                                file_ext = ext_from_type if ext_from_type else ".mp4"
+                            disp = resp.headers.get("Content-Disposition", "")
+                            if "filename=" in disp:
+                                file_name = disp.split("filename=")[1].split(";")[0].strip('"\' ')
+                            else:
+                                file_name = f"video{file_ext}"
+                            checkpoint["file_ext"] = file_ext
+                            checkpoint["file_name"] = file_name
+                        checkpoint["total_size"] = total_size
+                        checkpoint["downloaded"] = offset
+                        await self.save_checkpoint(checkpoint_path, checkpoint)
+                        if total_size:
+                            # Don't re-announce progress already shown before a resume
+                            last_percent = max(last_percent, int(offset * 100 / total_size))
+
+                        # Download in chunks, checkpointing the offset and updating progress
+                        downloaded = offset
+                        over_limit = False
+                        part_file = await asyncio.to_thread(open, part_path, "ab" if offset else "wb")
+                        try:
+                            async for chunk in resp.content.iter_chunked(chunk_size):
+                                if not chunk:
+                                    break
+                                downloaded += len(chunk)
+                                # Enforce the limit on the bytes actually received, since
+                                # Content-Length can be missing or wrong
+                                if downloaded > self.MAX_FILE_SIZE:
+                                    over_limit = True
+                                    break
+                                await asyncio.to_thread(part_file.write, chunk)
+                                if total_size:
+                                    percent = int(downloaded * 100 / total_size)
+                                    # Update progress message every 10%; the text always
+                                    # changes here, so Telegram never sees a no-op edit
+                                    if percent // 10 > last_percent // 10:
+                                        await progress_msg.edit_text(f"⬇️ Downloading... {percent}%")
+                                        last_percent = percent
+                        finally:
+                            await asyncio.to_thread(part_file.close)
+                        if over_limit:
+                            await self.send_too_large_message(progress_msg, total_size)
+                            await self.remove_partial(job_key)
+                            return "too_large"
+                        checkpoint["downloaded"] = downloaded
+                        await self.save_checkpoint(checkpoint_path, checkpoint)
+
+                        if not total_size or downloaded >= total_size:
+                            break
+                        # Stream ended early without an exception: resume
+                        attempt += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    attempt += 1
+                    logger.warning(f"Download of {job_key} interrupted ({e}), attempt {attempt}")
+                    checkpoint["downloaded"] = await asyncio.to_thread(self.partial_size, part_path)
+                    await self.save_checkpoint(checkpoint_path, checkpoint)
+                    await asyncio.sleep(min(2 ** attempt, 30))
+            else:
+                logger.error(f"Giving up on {job_key} after {self.MAX_RESUME_ATTEMPTS} resume attempts")
+                return None
+
+        file_ext = checkpoint.get("file_ext", ".mp4")
+        tmp_file_path = await asyncio.to_thread(self.finalize_partial, part_path, file_ext)
+        await self.remove_partial(job_key)
+        return tmp_file_path, checkpoint.get("file_name", f"video{file_ext}"), file_ext
+
+    async def send_too_large_message(self, progress_msg, size=0):
+        if size:
+            size_text = f"Detected file size: {self.format_file_size(size)}"
+        else:
+            size_text = "Detected file size: more than 100 MB"
+        await progress_msg.edit_text(
+            f"😊 Sorry, this feature is only available for files < 100 MB.\n"
+            f"{size_text}\n\n"
+            "Please use the direct download links instead!"
+        )
+
+    async def probe_url_metadata(self, session, url):
+        """
+        Return {"size", "content_type", "accept_ranges"} for url, or None if unknown.
+        Probes with HEAD, falling back to a Range 0-0 GET when HEAD is refused
+        or has no length. Results are cached per URL for METADATA_CACHE_TTL.
+        """
+        now = time.monotonic()
+        cached = self.url_metadata.get(url)
+        if cached and now - cached[0] < self.METADATA_CACHE_TTL:
+            return cached[1]
+
+        metadata = None
+        try:
+            async with session.head(url, allow_redirects=True) as resp:
+                if resp.status == 200 and resp.headers.get("Content-Length"):
+                    metadata = {
+                        "size": int(resp.headers["Content-Length"]),
+                        "content_type": resp.headers.get("Content-Type", ""),
+                        # A missing header doesn't mean Range is unsupported; only "none" does
+                        "accept_ranges": resp.headers.get("Accept-Ranges", "").lower() != "none",
+                    }
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"HEAD probe failed for {url}: {type(e).__name__}")
+        if metadata is None:
+            try:
+                async with session.get(url, headers={"Range": "bytes=0-0"}) as resp:
+                    if resp.status == 206:
+                        size = self.parse_content_range_total(resp.headers.get("Content-Range", ""))
+                        if size:
+                            metadata = {
+                                "size": size,
+                                "content_type": resp.headers.get("Content-Type", ""),
+                                "accept_ranges": True,
+                            }
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Range probe failed for {url}: {type(e).__name__}")
+
+        if metadata is not None:
+            self.url_metadata.pop(url, None)
+            self.url_metadata[url] = (now, metadata)
+            while len(self.url_metadata) > self.METADATA_CACHE_SIZE:
+                self.url_metadata.pop(next(iter(self.url_metadata)))
+        return metadata
+
+    async def remove_partial(self, job_key):
+        await asyncio.to_thread(self.delete_files, *self.partial_paths(job_key))
+
+    def remove_stale_partials(self, active_keys):
+        """
+        Delete partial files and checkpoints that have not been touched for
+        PARTIAL_FILE_TTL seconds and do not belong to an active download.
+        """
+        if not os.path.isdir(self.PARTIAL_DIR):
+            return
+        now = datetime.now().timestamp()
+        active = {os.path.basename(p) for key in active_keys for p in self.partial_paths(key)}
+        for entry in os.listdir(self.PARTIAL_DIR):
+            path = os.path.join(self.PARTIAL_DIR, entry)
+            if entry in active:
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.PARTIAL_FILE_TTL:
+                    os.remove(path)
+                    logger.info(f"Removed stale partial download {entry}")
+            except OSError as e:
+                logger.error(f"Failed to clean up {entry}: {e}")
+
+    async def cleanup_partial_downloads(self):
+        await asyncio.to_thread(self.remove_stale_partials, set(self.active_downloads))
+
+    async def partial_gc_loop(self):
+        while True:
+            await self.cleanup_partial_downloads()
+            await asyncio.sleep(self.PARTIAL_GC_INTERVAL)
+
+    async def post_init(self, application: Application):
+        self.partial_gc_task = asyncio.create_task(self.partial_gc_loop())
+
+    async def post_shutdown(self, application: Application):
+        if self.partial_gc_task:
+            self.partial_gc_task.cancel()
+            try:
+                await self.partial_gc_task
+            except asyncio.CancelledError:
+                pass
     
-    
 
 
 
+    # =================== ADMISSION CONTROL ===================
+    def build_rate_limiter(self, redis_url: Optional[str]):
+        if redis_url:
+            try:
+                return RedisTokenBucketLimiter(redis_url)
+            except ImportError:
+                logger.error("redis is not installed, falling back to local rate limits")
+        return TokenBucketLimiter()
+
+    async def admit(self, user_id, action: str, backend: Optional[str] = None,
+                    user_cost: float = 1, backend_cost: float = 1) -> float:
+        """
+        Check the user's bucket for action, then (if given) the shared bucket
+        for the upstream backend. Returns 0 if admitted, otherwise seconds to
+        wait. A backend rejection refunds the user's tokens, since the user
+        did not hit their own limit.
+        """
+        user_key = f"user:{user_id}:{action}"
+        user_rate, user_capacity = self.USER_RATE_LIMITS[action]
+        retry_after = await self.rate_limiter.acquire(user_key, user_rate, user_capacity, user_cost)
+        if retry_after or not backend:
+            return retry_after
+        rate, capacity = self.BACKEND_RATE_LIMITS[backend]
+        retry_after = await self.rate_limiter.acquire(f"backend:{backend}", rate, capacity, backend_cost)
+        if retry_after:
+            await self.rate_limiter.refund(user_key, user_rate, user_capacity, user_cost)
+        return retry_after
+
+    async def acquire_backend(self, backend: str) -> float:
+        """
+        Take a token from the backend's bucket before an upstream call.
+        Never waits: returns 0 if taken, otherwise seconds until one is free.
+        """
+        rate, capacity = self.BACKEND_RATE_LIMITS[backend]
+        return await self.rate_limiter.acquire(f"backend:{backend}", rate, capacity)
+
+    def count_files(self, items: List[Dict]) -> int:
+        count = 0
+        for item in items:
+            if item.get('is_dir') != '1':
+                count += 1 if item.get('fs_id') else 0
+            elif item.get('list'):
+                count += self.count_files(item['list'])
+        return count
+
+    def format_retry_after(self, retry_after: float) -> str:
+        return f"⏳ Too many requests. Please try again in {math.ceil(retry_after)}s."
+
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
+        # Expired buttons are answered by handle_get_video_callback without spending
+        # tokens; backend tokens are taken only when links are actually regenerated
+        if query.data.startswith("get_video|") and query.data.split("|", 1)[1] in self.video_callback_params:
+            needs_fetch = self.get_prefetched_link(query.data.split("|", 1)[1]) is None
+            retry_after = await self.admit(query.from_user.id, "video", "terabox" if needs_fetch else None)
+            if retry_after:
+                await query.answer(self.format_retry_after(retry_after), show_alert=True)
+                return
         await query.answer()
         try:
             if query.data == "show_sites":
@@ -358,30 +828,38 @@ Just send me any supported link and I'll provide download links for you!
 
             logger.info(f"[DEBUG] Params from callback: {params}")
 
-            # Regenerate fresh download links
-            download_urls = await self.fetch_terabox_download_urls(
-                mode=params.get("mode", 1),
-                uk=params.get("uk", ""),
-                shareid=params.get("shareid", ""),
-                timestamp=params.get("timestamp", 0),
-                sign=params.get("sign", ""),
-                js_token=params.get("js_token", ""),
-                cookie=params.get("cookie", ""),
-                fs_id=params.get("fs_id", "")
-            )
+            async def refresh_urls():
+                return await self.fetch_urls_for_params(params)
+
+            # Use the link kept warm by the speculative prefetcher if it is still fresh
+            prefetched_url = self.get_prefetched_link(unique_id)
+            prefetch_task = self.prefetch_tasks.pop(unique_id, None)
+            if prefetch_task:
+                prefetch_task.cancel()
+            if prefetched_url:
+                video_url = prefetched_url
+                logger.info(f"[DEBUG] Using prefetched link for {unique_id}")
+            else:
+                # Regenerate fresh download links; the backend token was taken on admission
+                download_urls = await self.fetch_urls_for_params(params, charge_backend=False)
 
-            logger.info(f"[DEBUG] Re-fetched download_urls: {download_urls}")
+                logger.info(f"[DEBUG] Re-fetched download_urls: {download_urls}")
 
-            if not download_urls or not any(download_urls):
-                await query.message.reply_text("😊 Download link not found or expired.")
-                return
+                if not download_urls or not any(download_urls):
+                    await query.message.reply_text("😊 Download link not found or expired.")
+                    return
 
-            video_url = next((url for url in download_urls if url), None)
-            if not video_url:
-                await query.message.reply_text("😊 No valid video download link found.")
-                return
+                video_url = next((url for url in download_urls if url), None)
+                if not video_url:
+                    await query.message.reply_text("😊 No valid video download link found.")
+                    return
 
-            await self.download_and_send_video(query.message, context, video_url)
+            job_key = f"{params.get('shareid', '')}_{params.get('fs_id', '')}"
+            await self.download_and_send_video(
+                query.message, context, video_url,
+                refresh_urls=refresh_urls, job_key=job_key,
+                known_size=params.get("size", 0)
+            )
 
         except Exception as e:
             logger.error(f"Error in handle_get_video_callback: {e}")
@@ -402,6 +880,13 @@ Just send me any supported link and I'll provide download links for you!
         
         user = update.message.from_user
         user_id = user.id
+        is_terabox = 'terabox' in message_text.lower() or '1024terabox' in message_text.lower()
+        # Reject before any upstream work so one user can't exhaust the backends
+        retry_after = await self.admit(user_id, "link", "terabox" if is_terabox else "vkr")
+        if retry_after:
+            await update.message.reply_text(self.format_retry_after(retry_after))
+            return
+
         username = user.username or f"{user.first_name or ''} {user.last_name or ''}".strip()
         await self.save_user_link(user_id, username, message_text.strip())
         
@@ -409,7 +894,7 @@ Just send me any supported link and I'll provide download links for you!
         
         processing_msg = await update.message.reply_text("🔄 Processing your link... Please wait!")
         try:
-            if 'terabox' in message_text.lower() or '1024terabox' in message_text.lower():
+            if is_terabox:
                 await self.process_terabox_link(update, context, message_text, processing_msg)
             else:
                 await self.process_general_link(update, context, message_text, processing_msg)
@@ -430,7 +915,17 @@ Just send me any supported link and I'll provide download links for you!
                     if response.status == 200:
                         data = await response.json()
                         if data.get('status') == 'success' and data.get('list'):
-                            await self.generate_all_download_links(data)
+                            # Pay for every generate_link call before making any: the first
+                            # file is covered by the link's own token, the rest by fan-out
+                            file_count = min(self.count_files(data['list']), self.MAX_FILES_PER_LINK)
+                            retry_after = await self.admit(
+                                update.message.from_user.id, "link", "terabox",
+                                user_cost=max(file_count - 1, 0), backend_cost=file_count
+                            )
+                            if retry_after:
+                                await processing_msg.edit_text(self.format_retry_after(retry_after))
+                                return
+                            await self.generate_all_download_links(data, max_files=file_count)
                             await processing_msg.delete()
                             await self.send_terabox_results(update, context, data)
                         else:
@@ -447,12 +942,20 @@ Just send me any supported link and I'll provide download links for you!
                 "😊 Something went wrong processing the TeraBox link."
             )
 
-    async def generate_all_download_links(self, data: Dict):
+    async def generate_all_download_links(self, data: Dict, max_files: int) -> int:
+        """
+        Resolve links for at most max_files files, already paid for by the
+        caller. Returns how many files were resolved.
+        """
         items = data.get('list', [])
+        resolved = 0
         for item in items:
+            if resolved >= max_files:
+                break
             if item.get('is_dir') != '1':
                 fs_id = item.get('fs_id', '')
                 if fs_id:
+                    resolved += 1
                     download_urls = await self.fetch_terabox_download_urls(
                         mode=data.get('mode', 1),
                         uk=str(data.get('uk', '')),
@@ -461,7 +964,8 @@ Just send me any supported link and I'll provide download links for you!
                         sign=str(data.get('sign', '')),
                         js_token=str(data.get('js_token', '')),
                         cookie=str(data.get('cookie', '')),
-                        fs_id=fs_id
+                        fs_id=fs_id,
+                        charge_backend=False
                     )
                     item['download_urls'] = download_urls
                     # Store the parameters so you can retrieve later
@@ -476,12 +980,108 @@ Just send me any supported link and I'll provide download links for you!
                     self.fs_id_to_download_urls[fs_id] = download_urls
             elif item.get('list'):
                 folder_data = {**data, 'list': item['list']}
-                await self.generate_all_download_links(folder_data)
+                resolved += await self.generate_all_download_links(folder_data, max_files - resolved)
+        return resolved
+
+
+    async def fetch_urls_for_params(self, params: Dict, charge_backend: bool = True) -> List[str]:
+        return await self.fetch_terabox_download_urls(
+            mode=params.get("mode", 1),
+            uk=params.get("uk", ""),
+            shareid=params.get("shareid", ""),
+            timestamp=params.get("timestamp", 0),
+            sign=params.get("sign", ""),
+            js_token=params.get("js_token", ""),
+            cookie=params.get("cookie", ""),
+            fs_id=params.get("fs_id", ""),
+            charge_backend=charge_backend
+        )
 
+    # =================== SPECULATIVE PREFETCH ===================
+    def get_prefetched_link(self, unique_id: str) -> Optional[str]:
+        prefetched = self.prefetched_links.get(unique_id)
+        if prefetched and time.monotonic() - prefetched[0] < self.LINK_TTL - self.PREFETCH_MARGIN:
+            return prefetched[1]
+        return None
+
+    def schedule_prefetch(self, unique_id: str, params: Dict, download_urls: List[str]):
+        if not self.speculative_prefetch or len(self.prefetch_tasks) >= self.PREFETCH_MAX_TASKS:
+            return
+        task = asyncio.create_task(self.prefetch_links(unique_id, params, download_urls))
+        self.prefetch_tasks[unique_id] = task
+        task.add_done_callback(lambda _: self.prefetch_tasks.pop(unique_id, None))
+
+    async def prefetch_links(self, unique_id: str, params: Dict, download_urls: List[str]):
+        """
+        Keep a working link ready for a rendered Get Video button: pick the
+        fastest mirror now, then regenerate links shortly before they expire,
+        at most PREFETCH_MAX_REFRESHES times. Every round takes a token from
+        the global "prefetch" budget and is skipped when none is left.
+        """
+        fetched_at = time.monotonic()
+        refreshes = 0
+        try:
+            while True:
+                if any(download_urls) and not await self.acquire_backend("prefetch"):
+                    async with self.prefetch_semaphore:
+                        winner = await self.pick_fastest_mirror(download_urls)
+                    if winner:
+                        self.prefetched_links[unique_id] = (fetched_at, winner)
+
+                if refreshes >= self.PREFETCH_MAX_REFRESHES:
+                    # Let the last link live out its TTL, then stop
+                    await asyncio.sleep(max(self.LINK_TTL - (time.monotonic() - fetched_at), 0))
+                    break
+                await asyncio.sleep(max(self.LINK_TTL - self.PREFETCH_MARGIN - (time.monotonic() - fetched_at), 0))
+                refreshes += 1
+                if await self.acquire_backend("prefetch"):
+                    break
+                async with self.prefetch_semaphore:
+                    # Never queue behind user traffic: skip the refresh if teradl-api is busy
+                    download_urls = await self.fetch_urls_for_params(params)
+                if not any(download_urls):
+                    break
+                fetched_at = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Prefetch error for {unique_id}: {e}")
+        finally:
+            self.prefetched_links.pop(unique_id, None)
+
+    async def pick_fastest_mirror(self, urls: List[str]) -> Optional[str]:
+        """
+        Probe all mirrors at once and return the first one that answers.
+        The probe also fills url_metadata, so the click skips it.
+        """
+        timeout = aiohttp.ClientTimeout(total=15)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            pending = {
+                asyncio.create_task(self.probe_url_metadata(session, url)): url
+                for url in urls if url
+            }
+            try:
+                while pending:
+                    done, _ = await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        url = pending.pop(task)
+                        if task.result() is not None:
+                            return url
+            finally:
+                # Let the losing probes finish cancelling before the session closes
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        return None
 
     async def fetch_terabox_download_urls(self, mode: int, uk: str, shareid: str, 
                                           timestamp: int, sign: str, js_token: str, 
-                                          cookie: str, fs_id: str) -> List[str]:
+                                          cookie: str, fs_id: str,
+                                          charge_backend: bool = True) -> List[str]:
+        # Callers that already paid for this call at admission pass charge_backend=False
+        if charge_backend and await self.acquire_backend("terabox"):
+            logger.warning("teradl-api budget exhausted, skipping generate_link call")
+            return []
         try:
             payload = {
                 'mode': mode,
@@ -584,6 +1184,8 @@ Just send me any supported link and I'll provide download links for you!
         size = int(item.get('size', 0))
         size_formatted = self.format_file_size(size)
         is_video = self.is_video_file(name)
+        # Only offer "Get Video" for files the bot can actually send
+        can_send_video = is_video and size <= self.MAX_FILE_SIZE
         file_type = "🎬" if is_video else "📄"
         message_text = f"{file_type} **{name}**\n"
         if size_formatted != "0 B":
@@ -591,6 +1193,8 @@ Just send me any supported link and I'll provide download links for you!
         else:
             message_text += "\n"
         message_text += "📥 **Download Options:**"
+        if is_video and not can_send_video:
+            message_text += "\n🎥 _Get Video is only available for files < 100 MB._"
         keyboard = []
         download_urls = item.get('download_urls', ['', '', ''])
         fs_id = str(item.get('fs_id', ''))
@@ -603,9 +1207,12 @@ Just send me any supported link and I'll provide download links for you!
             "js_token": item.get("js_token"),
             "cookie": item.get("cookie"),
             "fs_id": fs_id,
+            "size": size,
         }
         unique_id = str(uuid.uuid4())[:8]
-        self.video_callback_params[unique_id] = params
+        if can_send_video:
+            self.video_callback_params[unique_id] = params
+            self.schedule_prefetch(unique_id, params, download_urls)
         callback_data = f"get_video|{unique_id}"
     
         if fs_id:
@@ -618,7 +1225,7 @@ Just send me any supported link and I'll provide download links for you!
         if download_urls[2]:
             keyboard.append([InlineKeyboardButton("🔄 Download Link 3", url=download_urls[2])])
     
-        if is_video:
+        if can_send_video:
             keyboard.append([
                 InlineKeyboardButton("🎥 Get Video", callback_data=callback_data)
             ])
@@ -746,7 +1353,13 @@ Just send me any supported link and I'll provide download links for you!
 
     # =================== MAIN ===================
     def run(self):
-        application = Application.builder().token(self.bot_token).build()
+        application = (
+            Application.builder()
+            .token(self.bot_token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("sites", self.sites_command))
@@ -763,7 +1376,12 @@ def main():
         print("😊 Please set your bot token in the BOT_TOKEN variable!")
         print("Get your token from @BotFather on Telegram")
         return
-    bot = TelegramDownloaderBot(BOT_TOKEN)
+    speculative_prefetch = os.environ.get("SPECULATIVE_PREFETCH", "") == "1"
+    bot = TelegramDownloaderBot(
+        BOT_TOKEN,
+        speculative_prefetch=speculative_prefetch,
+        rate_limit_redis_url=os.environ.get("RATE_LIMIT_REDIS_URL")
+    )
     bot.run()
 
 if __name__ == "__main__":